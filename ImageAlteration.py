@@ -1,11 +1,34 @@
+import calendar
 import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from PIL import Image, ImageDraw, ImageFont, ImageOps, ExifTags
 from PIL.ExifTags import TAGS, GPSTAGS
-from pykml.factory import KML_ElementMaker as KML
-from lxml import etree
-from datetime import datetime
+from pykml.factory import nsmap as KML_NSMAP
+from lxml import etree, objectify
+from functools import lru_cache
 import shutil
 
+JPEG_SUFFIXES = (".jpg", ".jpeg")
+KML_NAMESPACE = KML_NSMAP[None]
+# Placemarks are built without a namespace so they inherit the one declared on the <kml> element.
+# pykml's KML_ElementMaker attaches its nsmap to every element, and the incremental writer would
+# declare it again on each placemark.
+KML = objectify.ElementMaker(annotate=False)
+
+@lru_cache(maxsize=8)
+def _get_font(name, size):
+    # Loading a TrueType font is expensive, so only do it once per name/size
+    return ImageFont.truetype(name, size)
+
+def _render_outlined(text, font):
+    # Let FreeType stroke the 3 pixel black halo in the same pass that renders the text
+    bbox = font.getbbox(text)
+    sprite = Image.new("RGBA", (bbox[2] + 6, bbox[3] + 6), (0, 0, 0, 0))
+    d = ImageDraw.Draw(sprite)
+    d.text((3, 3), text, font=font, fill=(50,205,50), stroke_width=3, stroke_fill="black")  # Use lime green color
+    return sprite
+
 def get_geotagging(exif):
     if not exif or 34853 not in exif:
         raise ValueError("No EXIF geotagging found")
@@ -32,11 +55,27 @@ def get_date_taken(exif):
     # Get the date from the EXIF data
     date_str = exif[306]
 
-    # Parse the date using strptime
-    date_obj = datetime.strptime(date_str, '%Y:%m:%d %H:%M:%S')
+    # EXIF dates are always YYYY:MM:DD HH:MM:SS, so slice the fields out instead of using strptime
+    error = f"Unrecognized EXIF date {date_str!r}"
+    digits = date_str[:4] + date_str[5:7] + date_str[8:10] + date_str[11:13] + date_str[14:16] + date_str[17:]
+    if len(date_str) != 19 or date_str[4:17:3] != ":: ::":
+        raise ValueError(error)
+    if not date_str.isascii() or not digits.isdigit():
+        raise ValueError(error)
+
+    # Check each field is in range, as strptime did
+    year, month, day = int(date_str[0:4]), int(date_str[5:7]), int(date_str[8:10])
+    hour, minute, second = int(date_str[11:13]), int(date_str[14:16]), int(date_str[17:19])
+    if year < 1 or not 1 <= month <= 12:
+        raise ValueError(error)
+    if not 1 <= day <= calendar.monthrange(year, month)[1]:
+        raise ValueError(error)
+    if hour > 23 or minute > 59 or second > 59:
+        raise ValueError(error)
 
     # Format the date as MM/DD/YYYY HH:MM AM/PM
-    formatted_date = date_obj.strftime('%m/%d/%Y %I:%M %p')
+    am_pm = "AM" if hour < 12 else "PM"
+    formatted_date = f"{month:02d}/{day:02d}/{year:04d} {hour % 12 or 12:02d}:{minute:02d} {am_pm}"
 
     return formatted_date
 
@@ -47,52 +86,45 @@ def get_orientation(exif_data):
             return value
     return 1  # Default orientation value if not found
 
-def rotate_image(exif_data, img):
-    #Rotate the image based on the orientation value.
- 
-    orientation = get_orientation(exif_data)
+def paste_upright(orientation, img, sprite, xy):
+    #Paste a sprite placed in upright coordinates onto the image as stored.
+    #For orientation 6 the upright view is the stored image turned 90 degrees clockwise,
+    #so turn the small sprite the other way instead of rotating the whole image twice.
+    x, y = xy
     if orientation == 6:
-        return img.rotate(270, expand=True)
-    return img
-
-def out_rotate_image(exif_data, img):
-    #Rotate the image back to vertical for the final output.
-   
-    orientation = get_orientation(exif_data)
-    if orientation == 6:
-        return img.rotate(-270, expand=True)
-    return img
+        sprite = sprite.rotate(90, expand=True)
+        x, y = y, img.height - x - sprite.height
+    img.paste(sprite, (x, y), sprite)
 
 def sanitize_exif(exif):
     sanitized = {}
     for tag, value in exif.items():
-        try:
-            # Check if the value is a bytes object and if all bytes are in range(0, 256)
-            if isinstance(value, bytes) and all(b in range(256) for b in value):
-                sanitized[tag] = value
-        except TypeError:
-            # The value is not iterable, skip it
-            pass
+        # Every byte of a bytes object is already in range(0, 256), so the type check is enough
+        if isinstance(value, bytes):
+            sanitized[tag] = value
     return sanitized
 
 def watermark_with_exif(fn):
     img = Image.open(fn)
+    # Image.open only reads the headers, so check the EXIF data before decoding any pixels
     exif_data = img._getexif()
-        # Resize the image (optional)
-    new_width, new_height = 1024, 768  # Specify the new width and height
-    img = img.resize((new_width, new_height))
-    img = rotate_image(exif_data, img)
 
     if exif_data is None:
         print(f"No EXIF data found for {fn}, skipping.")
-        return None
+        return None, None
 
     try:
         geotagging = get_geotagging(exif_data)
         date_taken = get_date_taken(exif_data)
     except ValueError as e:
         print(f"Error processing {fn}: {e}, skipping.")
-        return None
+        return None, None
+
+        # Resize the image (optional)
+    new_width, new_height = 1024, 768  # Specify the new width and height
+    # Let libjpeg scale by 1/2, 1/4 or 1/8 while decoding, then resize the rest of the way
+    img.draft("RGB", (new_width, new_height))
+    img = img.resize((new_width, new_height))
 
     # Convert the GPS coordinates to decimal format
     lat_deg, lat_min, lat_sec = geotagging[2]
@@ -113,39 +145,34 @@ def watermark_with_exif(fn):
     watermark_text_date = f"{date_taken}"
 
     # Draw the watermark onto the original image
-    d = ImageDraw.Draw(img)
-    font = ImageFont.truetype("arial", 30)  
-
-    # Position the watermark at the lower left corner for latitude and longitude
-    bbox = d.textbbox((0, 0), watermark_text_lat_lon, font=font)
-    textwidth, textheight = bbox[2], bbox[3]
+    font = _get_font("arial", 30)
+    ascent, descent = font.getmetrics()
+    textheight = ascent + descent  # Same for both labels, so measure it once
+    orientation = get_orientation(exif_data)
     width, height = img.size
+    if orientation == 6:
+        width, height = height, width  # Lay the labels out in the upright view
 
+    # Position the watermark at the lower left corner for latitude and longitude
     # The x-coordinate should always be 10 pixels from the left
     x = 10  # 10 pixels from the left
     y = height - textheight - 10  # 10 pixels from the bottom
 
 
-    # Draw black outline for halo effect
-    for adj in range(-3, 4):
-        d.text((x+adj, y), watermark_text_lat_lon, font=font, fill="black")
-        d.text((x, y+adj), watermark_text_lat_lon, font=font, fill="black")
-
-    d.text((x, y), watermark_text_lat_lon, font=font, fill=(50,205,50))  # Use lime green color
+    # Paste the lime green text with its black halo
+    sprite = _render_outlined(watermark_text_lat_lon, font)
+    paste_upright(orientation, img, sprite, (x-3, y-3))
 
     # Position the watermark at the lower right corner for date
-    bbox = d.textbbox((0, 0), watermark_text_date, font=font)
-    textwidth, textheight = bbox[2], bbox[3]
+    # getlength only shapes the text, unlike textbbox which rasterizes it to measure the ink
+    textwidth = font.getlength(watermark_text_date)
 
     # The x-coordinate should always be 10 pixels from the right
-    x = width - textwidth - 10  # 10 pixels from the right
-
-    # Draw black outline for halo effect
-    for adj in range(-3, 4):
-        d.text((x+adj, y), watermark_text_date, font=font, fill="black")
-        d.text((x, y+adj), watermark_text_date, font=font, fill="black")
+    x = int(width - textwidth - 10)  # 10 pixels from the right
 
-    d.text((x, y), watermark_text_date, font=font, fill=(50,205,50))  # Use lime green color
+    # Paste the lime green text with its black halo
+    sprite = _render_outlined(watermark_text_date, font)
+    paste_upright(orientation, img, sprite, (x-3, y-3))
 
     # Save the image to a temporary file
     filename, file_extension = os.path.splitext(fn)
@@ -155,16 +182,10 @@ def watermark_with_exif(fn):
     # Close the image file
     img.close()
 
-    # Replace the original image with the new image
-    os.remove(fn)
-    os.rename(temp_fn, fn)
-
-    # Rotate the image back to the original orientation
-    img = Image.open(fn)
-    img = out_rotate_image(exif_data, img)
-    img.save(fn, exif=img.info["exif"])
+    # Replace the original image with the new image in a single atomic step
+    os.replace(temp_fn, fn)
 
-    return date_taken
+    return date_taken, get_coordinates(geotagging)
 
 
 def rename_image(fn, date_taken):
@@ -192,6 +213,8 @@ def move_image(fn, date_taken, root_directory):
     new_path = os.path.join(new_folder_path, filename)
     shutil.move(fn, new_path)
 
+    return new_path  # Return the new path
+
 
 def get_decimal_from_dms(dms, ref):
     degrees = dms[0]
@@ -211,69 +234,109 @@ def get_coordinates(geotags):
 
     return (lat,lon)
 
-def process_images(directory):
-    for root, dirs, files in os.walk(directory):
-        for filename in files:
-            if filename.lower().endswith(".jpg") or filename.lower().endswith(".jpeg"):
-                path = os.path.join(root, filename)
-                date_taken = watermark_with_exif(path)
-                path = rename_image(path, date_taken)  # Update the path after renaming
-                move_image(path, date_taken, directory)  # Then move the image
-
-    # After processing all images, call the function from script 2 for each subdirectory
-    for subdirectory in os.listdir(directory):
-        subdirectory_path = os.path.join(directory, subdirectory)
-        if os.path.isdir(subdirectory_path):
-            create_kml(subdirectory_path)
-
-
-
-def create_kml(folder_path):
-    kml_doc = KML.kml(KML.Document())  # Create a Document element inside the KML root element
-
-    for filename in os.listdir(folder_path):
-        if filename.lower().endswith(".jpg") or filename.lower().endswith(".png"):
-            image_path = os.path.join(folder_path, filename)
-            image_path = os.path.normpath(image_path)  # Normalize the path to use the correct platform-specific separator
-            image_path = image_path.replace("\\", "/")  # Replace backslashes with forward slashes
-            image = Image.open(image_path)
-            exif = image._getexif()
-            try:
-                geotags = get_geotagging(exif)
-                coordinates = get_coordinates(geotags)
-                placemark = KML.Placemark(
-                    KML.name(filename),
-                    KML.LookAt(
-                        KML.longitude(coordinates[1]),
-                        KML.latitude(coordinates[0]),
-                        KML.range(1000),  # Adjust this value to change the initial zoom level
-                        KML.tilt(0),
-                        KML.heading(0),
-                    ),
-                    KML.Point(
-                        KML.coordinates(f"{coordinates[1]},{coordinates[0]}")
-                    ),
-                    KML.description(
-                        '<img style="max-width:500px;" src="file:///{}">'.format(image_path)
-                    )
-                )
-                kml_doc.Document.append(placemark)
-            except ValueError as e:
-                print(f"Skipping {filename}: {e}")
-
-    kml_str = etree.tostring(kml_doc, pretty_print=True).decode()
+def _iter_jpegs(directory):
+    subdirectories = []
+    try:
+        entries = os.scandir(directory)
+    except OSError:
+        return  # Skip directories that can't be read, as os.walk does
+
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+            elif entry.is_file() and entry.name.lower().endswith(JPEG_SUFFIXES):
+                yield entry.path
+
+    for subdirectory in subdirectories:
+        yield from _iter_jpegs(subdirectory)
+
+def _process_one(path, root_directory):
+    date_taken, coordinates = watermark_with_exif(path)
+    path = rename_image(path, date_taken)  # Update the path after renaming
+    path = move_image(path, date_taken, root_directory)  # Then move the image
+    return path, coordinates
+
+def _record_placemark(placemarks_by_folder, result):
+    # Group each processed image under the folder it ended up in so the KML step needs no second walk
+    path, coordinates = result
+    if path is not None:
+        placemarks_by_folder.setdefault(os.path.dirname(path), []).append((path, coordinates))
 
+def process_images(directory):
+    # Collect the paths up front so images moved into the date folders are not picked up again
+    paths = list(_iter_jpegs(directory))
+
+    # Each image is independent, so spread them across all cores one image per task;
+    # a task only ships a path and a small tuple, so there is no IPC cost worth batching
+    placemarks_by_folder = {}
+    # The default worker count is the CPU count, capped at 61 on Windows
+    with ProcessPoolExecutor() as executor:
+        for result in executor.map(_process_one, paths, repeat(directory)):
+            _record_placemark(placemarks_by_folder, result)
+
+    # After processing all images, call the function from script 2 for each folder that received images
+    for folder_path, images in placemarks_by_folder.items():
+        create_kml(folder_path, sorted(images))
+
+
+
+def create_placemark(filename, image_path, coordinates):
+    return KML.Placemark(
+        KML.name(filename),
+        KML.LookAt(
+            KML.longitude(coordinates[1]),
+            KML.latitude(coordinates[0]),
+            KML.range(1000),  # Adjust this value to change the initial zoom level
+            KML.tilt(0),
+            KML.heading(0),
+        ),
+        KML.Point(
+            KML.coordinates(f"{coordinates[1]},{coordinates[0]}")
+        ),
+        KML.description(
+            '<img style="max-width:500px;" src="file:///{}">'.format(image_path)
+        )
+    )
+
+def create_kml(folder_path, images):
+    #Write a KML file for the folder with one placemark per (image_path, coordinates) pair.
     # Get the folder name and create the KML file name
     folder_name = os.path.basename(folder_path)
     kml_file_name = f"{folder_name}_locations.kml"
     kml_file_path = os.path.join(folder_path, kml_file_name)
 
-    with open(kml_file_path, "w") as f:
-        f.write(kml_str)
+    # Stream each placemark to a temporary file as it is built instead of holding the whole document in memory
+    temp_kml_file_path = kml_file_path + ".tmp"
+    try:
+        with etree.xmlfile(temp_kml_file_path, encoding="utf-8") as xf:
+            xf.write_declaration()
+            # Declare all of pykml's namespaces once on the root element
+            with xf.element(f"{{{KML_NAMESPACE}}}kml", nsmap=KML_NSMAP):
+                xf.write("\n  ")
+                with xf.element(f"{{{KML_NAMESPACE}}}Document"):
+                    for image_path, coordinates in images:
+                        filename = os.path.basename(image_path)
+                        image_path = os.path.normpath(image_path)  # Normalize the path to use the correct platform-specific separator
+                        image_path = image_path.replace("\\", "/")  # Replace backslashes with forward slashes
+                        placemark = create_placemark(filename, image_path, coordinates)
+                        etree.indent(placemark, space="  ", level=2)
+                        xf.write("\n    ", placemark)
+                        xf.flush()
+                    xf.write("\n  ")
+                xf.write("\n")
+    except BaseException:
+        if os.path.exists(temp_kml_file_path):
+            os.remove(temp_kml_file_path)  # Don't leave a half-written file behind
+        raise
+
+    # Only replace the previous KML file once the new one is complete
+    os.replace(temp_kml_file_path, kml_file_path)
 
     print(f"KML file has been written to {kml_file_path}")
 
  
 # Call the function with the path to your directory
-process_images(r"C:\\Users\\Alexander.Hutcheson\\OneDrive - Michael Baker International\\Desktop\\Misc\\scratch\\BreakupPhotos\\testImages")
+if __name__ == "__main__":
+    process_images(r"C:\\Users\\Alexander.Hutcheson\\OneDrive - Michael Baker International\\Desktop\\Misc\\scratch\\BreakupPhotos\\testImages")
 